@@ -1,105 +1,136 @@
 #!/usr/bin/env python3
 import os
+import json
+import hashlib
 import logging
+from io import StringIO
 from pathlib import Path
 from argparse import ArgumentParser
 
-logging.basicConfig(level=logging.DEBUG)
-
 # --- Import Pegasus API ------------------------------------------------------
-from Pegasus.api import *
+from Pegasus.api import (
+    Arch,
+    Directory,
+    File,
+    FileServer,
+    Job,
+    Namespace,
+    Operation,
+    OS,
+    Properties,
+    ReplicaCatalog,
+    Site,
+    SiteCatalog,
+    SubWorkflow,
+    Transformation,
+    TransformationCatalog,
+    Workflow,
+)
 TOP_DIR = Path(__file__).resolve().parent
 
-def generate_workflow(exec_site_name):
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def write_if_changed(catalog, path):
+    # the catalog is only written when its content differs from the last write or
+    # the file on disk no longer holds the bytes that were written; both digests
+    # are recorded in <path>.sig. this keeps the file's mtime and checksum stable
+    # across reruns of the generator while still restoring edited files
+    model = _digest(json.dumps(catalog, default=lambda obj: obj.__json__()).encode())
+    target = Path(path)
+    sig = Path("{}.sig".format(path))
+    if target.exists() and sig.exists():
+        if sig.read_text() == "{} {}".format(model, _digest(target.read_bytes())):
+            return
+
+    catalog.write(path)
+    sig.write_text("{} {}".format(model, _digest(target.read_bytes())))
+
+def generate_workflow(exec_site_name, skip_sites_catalog=False):
     # --- Properties ---------------------------------------------------------------
     # properties that will be used by both the outer workflow  and inner diamond workflow
     print("Creating workflow properties...")
     props = Properties()
-    props.write()
 
-    # properties that will be used by inner diamond workflow
-    props["pegasus.catalog.transformation.file"] = "inner_diamond_workflow_tc.yml"
-    props["pegasus.catalog.replica.file"] = "inner_diamond_workflow_rc.yml"
-    props.write("inner_diamond_workflow.pegasus.properties")
+    # properties that will be used by inner diamond workflow; seeded with a copy
+    # of the shared properties above
+    with StringIO() as shared:
+        props.write(shared)
+        shared.seek(0)
+        inner_props = Properties.load(shared)
+    inner_props["pegasus.catalog.transformation.file"] = "inner_diamond_workflow_tc.yml"
+    inner_props["pegasus.catalog.replica.file"] = "inner_diamond_workflow_rc.yml"
+    inner_props.write("inner_diamond_workflow.pegasus.properties")
     
     # --- Sites --------------------------------------------------------------------
-    sc = SiteCatalog()
-    print("Creating execution sites...")
-    # local site
-    local_site = Site(name="local", arch=Arch.X86_64, os_type=OS.LINUX, os_release="rhel", os_version="7")
-    local_site.add_directories(
-        Directory(Directory.SHARED_SCRATCH, TOP_DIR / "work/local-site/scratch")
-            .add_file_servers(FileServer("file://{}".format(TOP_DIR / "work/local-site/scratch"), Operation.ALL)),
-        Directory(Directory.LOCAL_STORAGE, TOP_DIR / "outputs/local-site")
-            .add_file_servers(FileServer("file://{}".format(TOP_DIR / "outputs/local-site"), Operation.ALL))
+    if not skip_sites_catalog:
+        sc = SiteCatalog()
+        print("Creating execution sites...")
+        # local site
+        local_site = Site(name="local", arch=Arch.X86_64, os_type=OS.LINUX, os_release="rhel", os_version="7")
+        scratch = TOP_DIR / "work/local-site/scratch"
+        storage = TOP_DIR / "outputs/local-site"
+        local_site.add_directories(
+            Directory(Directory.SHARED_SCRATCH, scratch)
+                .add_file_servers(FileServer("file://{}".format(scratch), Operation.ALL)),
+            Directory(Directory.LOCAL_STORAGE, storage)
+                .add_file_servers(FileServer("file://{}".format(storage), Operation.ALL))
+                )
+
+        exec_site = (
+                Site(exec_site_name)
+                .add_pegasus_profile(style="condor")
+                .add_condor_profile(universe="vanilla")
+                .add_profiles(Namespace.PEGASUS, key="data.configuration", value="condorio")
             )
 
-    exec_site = (
-            Site(exec_site_name)
-            .add_pegasus_profile(style="condor")
-            .add_condor_profile(universe="vanilla")
-            .add_profiles(Namespace.PEGASUS, key="data.configuration", value="condorio")
-        )
+        sc.add_sites(local_site, exec_site)
 
-    sc.add_sites(local_site, exec_site)
-    sc.write()
+        # sites.yml is rewritten when the site catalog changes or the file on disk
+        # no longer matches what was generated (e.g. after a hand edit made for a
+        # --skip_sites_catalog run)
+        write_if_changed(sc, "sites.yml")
     
     # --- Transformations ----------------------------------------------------------
     # create transformation catalog for the outer level workflow
     print("Creating transformation catalog...")
-    wc = Transformation(
-                        name="wc",
-                        site="condorpool",
-                        pfn="/usr/bin/wc",
-                        is_stageable=False
-        )
-
-    curl = Transformation(
-                        name="curl",
-                        site="condorpool",
-                        pfn="/usr/bin/curl",
-                        is_stageable=False
-        )
+    system_tool = dict(site="condorpool", is_stageable=False)
+    wc = Transformation(name="wc", pfn="/usr/bin/wc", **system_tool)
+    curl = Transformation(name="curl", pfn="/usr/bin/curl", **system_tool)
 
     tc = TransformationCatalog()
     tc.add_transformations(wc,curl)
-    tc.write()
     
     # create transformation catalog for the inner diamond workflow
-    preprocess = Transformation(
-                name="preprocess",
-                site="condorpool",
-                pfn="/usr/bin/pegasus-keg",
-                is_stageable=True
-            )
-
-    findrange = Transformation(
-                name="findrange",
-                site="condorpool",
-                pfn="/usr/bin/pegasus-keg",
-                is_stageable=True
-            )
-
-    analyze = Transformation(
-                name="analyze",
-                site="condorpool",
-                pfn="/usr/bin/pegasus-keg",
-                is_stageable=True
-            )
+    keg = dict(site="condorpool", pfn="/usr/bin/pegasus-keg", is_stageable=True)
+    preprocess, findrange, analyze = (
+        Transformation(name=name, **keg)
+        for name in ("preprocess", "findrange", "analyze")
+    )
+    # the two parallel findrange jobs are clustered horizontally into a single
+    # job so that the inner workflow pays the scheduling overhead only once;
+    # pegasus-cluster is told to run both tasks in parallel inside that job,
+    # otherwise it would run them one after the other
+    findrange.add_pegasus_profile(clusters_size=2, job_aggregator_arguments="-n 2")
 
     inner_diamond_workflow_tc = TransformationCatalog()
     inner_diamond_workflow_tc.add_transformations(preprocess, findrange, analyze)
-    inner_diamond_workflow_tc.write("inner_diamond_workflow_tc.yml")
+    write_if_changed(inner_diamond_workflow_tc, "inner_diamond_workflow_tc.yml")
     
     # --- Replicas -----------------------------------------------------------------
 
+    # files needed to plan the inner diamond workflow; the same handles are
+    # registered here and used as inputs of the sub-workflow job
+    inner_props_file = File("inner_diamond_workflow.pegasus.properties", for_planning=True)
+    inner_tc_file = File("inner_diamond_workflow_tc.yml", for_planning=True)
+    inner_wf_file = File("inner_diamond_workflow.yml", for_planning=True)
+    sites_file = File("sites.yml", for_planning=True)
+
     # replica catalog for the outer workflow
     rc = ReplicaCatalog()
-    rc.add_replica(site="local", lfn="inner_diamond_workflow.pegasus.properties", pfn=TOP_DIR / "inner_diamond_workflow.pegasus.properties")
-    rc.add_replica(site="local", lfn="inner_diamond_workflow_tc.yml", pfn=TOP_DIR / "inner_diamond_workflow_tc.yml")
-    rc.add_replica(site="local", lfn="inner_diamond_workflow.yml", pfn=TOP_DIR / "inner_diamond_workflow.yml")
-    rc.add_replica(site="local", lfn="sites.yml", pfn=TOP_DIR / "sites.yml")
-    rc.write()
+    add_replica = rc.add_replica
+    for f in (inner_props_file, inner_tc_file, inner_wf_file, sites_file):
+        add_replica(site="local", lfn=f, pfn=str(TOP_DIR / f.lfn))
     
     # --- Workflow -----------------------------------------------------------------
     wf = Workflow("hierarchical-workflow")
@@ -140,24 +171,26 @@ def generate_workflow(exec_site_name):
             .add_inputs(fc1, fc2)
             .add_outputs(fd),
         )
-        .write(file="inner_diamond_workflow.yml")
+        .write(file=inner_wf_file.lfn)
     )
     
     # job to plan and run the diamond workflow
-    diamond_wf_job = SubWorkflow(file="inner_diamond_workflow.yml", is_planned=False, _id="diamond_subworkflow")\
+    diamond_wf_job = SubWorkflow(file=inner_wf_file, is_planned=False, _id="diamond_subworkflow")\
                     .add_args(
                         "--conf",
-                        "inner_diamond_workflow.pegasus.properties",
+                        inner_props_file.lfn,
                         "--output-sites",
                         "local",
                         "-vvv",
                         "--basename",
-                        "inner"
+                        "inner",
+                        "--cluster",
+                        "horizontal"
                     )\
                     .add_inputs(
-                        File("inner_diamond_workflow.pegasus.properties", for_planning=True),
-                        File("inner_diamond_workflow_tc.yml", for_planning=True),
-                        File("sites.yml", for_planning=True),
+                        inner_props_file,
+                        inner_tc_file,
+                        sites_file,
                         webpage
                     )\
                     .add_outputs(fd)
@@ -165,17 +198,27 @@ def generate_workflow(exec_site_name):
     count = File("count.txt")
     wc_job = (
             Job(wc)
-            .add_args("-l", fd)\
-            .add_inputs(fd)\
+            .add_args("-l", fd)
+            .add_inputs(fd)
             .set_stdout(count, stage_out=True, register_replica=True)
         )
     wf.add_jobs(curl_job,diamond_wf_job, wc_job)
     wf.add_dependency(curl_job, children=[diamond_wf_job])
     wf.add_dependency(diamond_wf_job, children=[wc_job])
-    
-    wf.write("workflow.yml")
+
+    # --- Write --------------------------------------------------------------------
+    # outer workflow properties, catalogs and the workflow itself go to their
+    # default file names
+    for obj in (props, tc, rc, wf):
+        obj.write()
 
 if __name__ == "__main__":
+    # debug logging (including the Pegasus API's own records) is opt-in through
+    # PEGASUS_GEN_DEBUG=1; otherwise only warnings and errors are shown
+    logging.basicConfig(
+        level=logging.DEBUG if os.environ.get("PEGASUS_GEN_DEBUG") == "1" else logging.WARNING
+    )
+
     parser = ArgumentParser(description="Pegasus Hierarchical Workflow")
 
     parser.add_argument(
@@ -203,5 +246,5 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     
-    generate_workflow(args.execution_site_name)
+    generate_workflow(args.execution_site_name, args.skip_sites_catalog)
     